@@ -1,41 +1,218 @@
 """
-Download json files from UniProtKB API using accessions from corresponding splits. 
-Execute the python script from the root directory of the project.
+Download json files from UniProtKB API using accessions from corresponding splits and process
+them on the fly into a single jsonl file for each split. Execute the python script from the root
+directory of the project.
+
+Downloads are dispatched concurrently with aiohttp so that wall-clock time is bound by bandwidth
+rather than per-request round-trip latency. Concurrency is capped with a semaphore to stay polite
+towards the UniProt servers. Each response is processed as soon as it arrives, so the raw json
+files never touch the disk unless --keep-raw is passed, in which case process.py can be used to
+reprocess them offline later.
 """
 
-import json
+import argparse
+import asyncio
 import os
-import requests
+from typing import List, Optional
+
+import aiohttp
+import orjson
+import zstandard as zstd
+from tqdm.asyncio import tqdm
 
-from tqdm import tqdm
+from process import protein_to_lines
 
 
 READ_TXT_ROOT_DIR = "./data"  # expected to contain test.txt, val.txt and train.txt
 SAVE_JSON_ROOT_DIR = "/ssd1/UniProtKB/download"  # expected to contain /test, /val and /train
+SAVE_JSONL_DIR = "/ssd1/UniProtKB/processed"
 BASE_URL = "https://rest.uniprot.org/uniprotkb"  # see: https://www.uniprot.org/help/uniprotkb
+MAX_CONCURRENT_REQUESTS = 64
+RAW_WRITER_TASKS = 4  # writer tasks draining raw json files to disk when --keep-raw is passed
+REQUEST_TIMEOUT_SECONDS = 30
+MAX_RETRIES = 5
+RETRY_BACKOFF_SECONDS = 0.3  # doubled after each failed attempt
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+async def fetch(
+    session: aiohttp.ClientSession,
+    semaphore: asyncio.Semaphore,
+    accession: str,
+    queue: asyncio.Queue,
+    raw_queue: Optional[asyncio.Queue],
+    save_json_dir: Optional[str],
+) -> None:
+    """Download and process a single accession, pushing its jsonl lines onto the queue."""
+    url = f"{BASE_URL}/{accession}.json"
+
+    # when a raw copy exists from a previous --keep-raw run, send its stored ETag so the
+    # server answers 304 instead of re-transferring an unchanged body
+    save_json_path = None
+    headers = None
+    if save_json_dir is not None:
+        save_json_path = os.path.join(save_json_dir, f"{accession}.json")
+        if os.path.exists(save_json_path):
+            etag = _read_etag(save_json_path)
+            if etag is not None:
+                headers = {"If-None-Match": etag}
+
+    async with semaphore:
+        for attempt in range(MAX_RETRIES):
+            try:
+                async with session.get(url, headers=headers) as response:
+
+                    # for status code, see: https://en.wikipedia.org/wiki/List_of_HTTP_status_codes
+                    if response.status == 200:
+                        data = await response.json(loads=orjson.loads)
+                        if raw_queue is not None:
+                            await raw_queue.put((
+                                save_json_path,
+                                orjson.dumps(data, option=orjson.OPT_INDENT_2),
+                                response.headers.get("ETag"),
+                            ))
+                        lines = await asyncio.to_thread(protein_to_lines, data)
+                        await queue.put(lines)
+                        return
+
+                    elif response.status == 304:
+                        # unchanged on the server, reprocess the local copy instead
+                        data = await asyncio.to_thread(_load_json, save_json_path)
+                        lines = await asyncio.to_thread(protein_to_lines, data)
+                        await queue.put(lines)
+                        return
+
+                    elif response.status in RETRY_STATUS_CODES:
+                        await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+                    else:
+                        break
+
+            # connection resets and timeouts are as transient as a 5xx, retry them with the
+            # same backoff instead of letting them abort the whole split
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+        print(f"Failed to download {accession}")
+
+
+def _read_etag(save_json_path: str) -> Optional[str]:
+    etag_path = f"{save_json_path}.etag"
+    if not os.path.exists(etag_path):
+        return None
+    with open(etag_path, "r") as f:
+        return f.read().strip() or None
+
+
+def _load_json(save_json_path: str):
+    with open(save_json_path, "rb") as f:
+        return orjson.loads(f.read())
 
 
-if __name__ == "__main__": 
-    for split in ["test", "val", "train"]: 
+def _write_raw(save_json_path: str, payload: bytes, etag: Optional[str]) -> None:
+    with open(save_json_path, "wb") as f:
+        f.write(payload)
+    if etag is not None:
+        with open(f"{save_json_path}.etag", "w") as f:
+            f.write(etag)
+
+
+async def _drain_raw_queue(raw_queue: asyncio.Queue) -> None:
+    """Consume serialized raw json files and write them to disk off the event loop."""
+    while True:
+        save_json_path, payload, etag = await raw_queue.get()
+        await asyncio.to_thread(_write_raw, save_json_path, payload, etag)
+        raw_queue.task_done()
+
+
+async def _drain_queue(queue: asyncio.Queue, save_file) -> None:
+    """Consume jsonl lines from the queue and write them, keeping a single writer per split."""
+    while True:
+        lines: List[bytes] = await queue.get()
+        # ZstdCompressionWriter does not implement writelines, so join into a single write
+        save_file.write(b"".join(lines))
+        queue.task_done()
+
+
+async def _race_writers(task: "asyncio.Task", writers: List["asyncio.Task"]) -> None:
+    """
+    Wait for task while watching the writer tasks, which only ever finish by failing. A dead
+    writer must be surfaced immediately: producers would otherwise block forever on its
+    bounded queue instead of crashing the split.
+    """
+    done, _ = await asyncio.wait([task, *writers], return_when=asyncio.FIRST_COMPLETED)
+    for finished in done:
+        if finished is not task:
+            task.cancel()
+            raise finished.exception()
+    task.result()  # re-raises if the awaited task itself failed
+
+
+async def download_split(split: str, keep_raw: bool) -> None:
+    """Download and process the json files of all accessions of a single split concurrently."""
+    save_json_dir = None
+    if keep_raw:
         save_json_dir = os.path.join(SAVE_JSON_ROOT_DIR, split)
         if not os.path.exists(save_json_dir):
             os.makedirs(save_json_dir)
+    if not os.path.exists(SAVE_JSONL_DIR):
+        os.makedirs(SAVE_JSONL_DIR)
+
+    read_txt_path = os.path.join(READ_TXT_ROOT_DIR, f"{split}.txt")
+    with open(read_txt_path, "r") as file:
+        accessions = [line.strip() for line in file]
+
+    save_jsonl_path = os.path.join(SAVE_JSONL_DIR, f"{split}.jsonl.zst")
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONCURRENT_REQUESTS, limit_per_host=MAX_CONCURRENT_REQUESTS, keepalive_timeout=60
+    )
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS)
+
+    compressor = zstd.ZstdCompressor(level=3, threads=-1)
+    with open(save_jsonl_path, "wb", buffering=1 << 20) as raw_file, \
+            compressor.stream_writer(raw_file) as save_file:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=1000)
+        consumer = asyncio.create_task(_drain_queue(queue, save_file))
+
+        # raw json files are pushed onto a bounded queue drained by a few writer tasks, so
+        # fetch coroutines never wait on disk themselves
+        raw_queue: Optional[asyncio.Queue] = None
+        raw_writers = []
+        if keep_raw:
+            raw_queue = asyncio.Queue(maxsize=1000)
+            raw_writers = [
+                asyncio.create_task(_drain_raw_queue(raw_queue)) for _ in range(RAW_WRITER_TASKS)
+            ]
+
+        writers = [consumer] + raw_writers
+        try:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                fetches = asyncio.ensure_future(tqdm.gather(
+                    *[
+                        fetch(session, semaphore, accession, queue, raw_queue, save_json_dir)
+                        for accession in accessions
+                    ],
+                    desc=split,
+                    mininterval=1.0,
+                    smoothing=0,
+                ))
+                await _race_writers(fetches, writers)
+            await _race_writers(asyncio.ensure_future(queue.join()), writers)
+            if raw_queue is not None:
+                await _race_writers(asyncio.ensure_future(raw_queue.join()), writers)
+        finally:
+            for writer in writers:
+                writer.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--keep-raw", action="store_true",
+        help="also save the raw json file of each accession under SAVE_JSON_ROOT_DIR",
+    )
+    args = parser.parse_args()
 
-        read_txt_path = os.path.join(READ_TXT_ROOT_DIR, f"{split}.txt")
-        with open(read_txt_path, "r") as file:
-            accessions = [line.strip() for line in file]
-
-        for accession in tqdm(accessions, postfix=f"{split}"):
-            url = f'{BASE_URL}/{accession}.json'
-            response = requests.get(url)
-
-            # for status code, see: https://en.wikipedia.org/wiki/List_of_HTTP_status_codes
-            if response.status_code == 200:  
-                data = response.json()
-                save_json_path = os.path.join(save_json_dir, f"{accession}.json")
-                with open(save_json_path, "w") as f:
-                    json.dump(data, f, indent=4)
-            
-            else:
-                print(f"Failed to download {accession}")
-                continue
+    for split in ["test", "val", "train"]:
+        asyncio.run(download_split(split, keep_raw=args.keep_raw))
@@ -1,15 +1,48 @@
 """
-Extract features from downloaded UniProtKB json files and merge them into a single jsonl file for each split.
-Features not mentioned in the downloaded json files will be set to an empty string in the output jsonl file.
+Extract features from downloaded UniProtKB json files and merge them into a single parquet file
+for each split, or a zstd-compressed jsonl file when --jsonl is passed.
+Features not mentioned in the downloaded json files will be set to an empty string in the output file.
 
 Sequences longer than 1024 amino-acid tokens will be segmented into overlapping sequences of length 1024 with 
 overlapping length 256. Each record in the output jsonl file thus corresponds to a segmented sequence.
 """
 
-import json
+import argparse
+import collections
+import multiprocessing
 import os
-import re
-from typing import Any, Dict, List
+import sys
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+import zstandard as zstd
+
+# prefer the linear-time RE2 engine over CPython's backtracking engine, falling back to the
+# faster third-party regex module then to the stdlib when unavailable
+try:
+    import re2 as re
+except ImportError:
+    try:
+        import regex as re
+    except ImportError:
+        import re
+
+# when Numba is available the PubMed annotations are stripped by a jitted byte scanner instead
+# of the regex engine, which avoids per-call engine overhead on the many short fields
+try:
+    import numpy as np
+    from numba import njit
+except ImportError:
+    njit = None
+
+# when ijson is available the downloaded files are parsed as a stream so that only the
+# top-level keys consumed by the extractors are materialized as Python objects
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 from tqdm import tqdm
 
@@ -17,29 +50,61 @@ from tqdm import tqdm
 READ_JSON_ROOT_DIR = "/ssd1/UniProtKB/download"  # expected to contain /test, /val and /train
 SAVE_JSON_DIR = "/ssd1/UniProtKB/processed"
 
+_PUBMED_RE = re.compile(r'\([^()]*PubMed[^()]*\)')
 
-def get_features(data: Dict[str, Any]) -> Dict[str, str]: 
+# the only top-level keys of a downloaded json file read by the extractors
+_WANTED_KEYS = frozenset({"primaryAccession", "sequence", "organism", "comments"})
+
+_RECORD_KEYS = (
+    "accession", "sequence",
+    "organism", "family", "domain",
+    "location", "subunit", "activity", "cofactor", "ptm",
+    "pathway", "tissue", "induction",
+    "description"
+)
+
+# all records share the same flat schema of string columns, an ideal fit for parquet with
+# dictionary encoding which physically dedups the repeated annotation strings
+_PARQUET_SCHEMA = pa.schema([(key, pa.string()) for key in _RECORD_KEYS])
+PARQUET_BATCH_SIZE = 10_000  # records accumulated before each row group is written
+
+
+def get_features(data: Dict[str, Any]) -> Dict[str, str]:
     """Extract features from a UniProtKB json file then clean up the text."""
     gathered_dict: Dict[str, str] = {}
-    
-    for key in [
-        "accession", "sequence", 
-        "organism", "family", "domain", 
-        "location", "subunit", "activity", "cofactor", "ptm", 
-        "pathway", "tissue", "induction",
-        "description"
-    ]: 
-        try: 
-            function_name = f"_get_{key}"
-            gathered_dict[key] = globals()[function_name](data)
-            gathered_dict[key] = _remove_pubmed_annotation(gathered_dict[key])
-        except KeyError: 
+    buckets = _bucket_comments(data)
+
+    for key, extractor in _DATA_EXTRACTORS:
+        try:
+            gathered_dict[key] = _remove_pubmed_annotation(extractor(data))
+        except KeyError:
             gathered_dict[key] = ""
             print(f"KeyError: {key} encountered in protein {_get_accession(data)}")
 
+    for key, extractor in _COMMENT_EXTRACTORS:
+        try:
+            gathered_dict[key] = _remove_pubmed_annotation(extractor(buckets))
+        except KeyError:
+            gathered_dict[key] = ""
+            print(f"KeyError: {key} encountered in protein {_get_accession(data)}")
+
+    # identical annotation strings recur across many proteins (organism above all), so interning
+    # lets the duplicates share a single str object within the process
+    for key in gathered_dict:
+        if key not in ("accession", "sequence"):
+            gathered_dict[key] = sys.intern(gathered_dict[key])
+
     return gathered_dict
 
 
+def _bucket_comments(data: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    """Group the comments of a protein by commentType in a single pass over the list."""
+    buckets: Dict[str, List[Dict[str, Any]]] = collections.defaultdict(list)
+    for comment in data.get("comments", []):
+        buckets[comment["commentType"]].append(comment)
+    return buckets
+
+
 def _get_accession(data: Dict[str, Any]) -> str: 
     return data["primaryAccession"]
 
@@ -52,41 +117,35 @@ def _get_name(data: Dict[str, Any]) -> str:
     return data["proteinDescription"]["recommendedName"]["fullName"]["value"]
 
 
-def _get_description(data: Dict[str, Any]) -> str: 
-    comments: List[Dict[str, Any]] = data["comments"]
-    functions = [
-        text["value"] 
-        for comment in comments if comment["commentType"] == "FUNCTION"
+def _get_description(buckets: Dict[str, List[Dict[str, Any]]]) -> str:
+    return " | ".join(
+        text["value"]
+        for comment in buckets.get("FUNCTION", [])
         for text in comment["texts"]
-    ]
-    return " | ".join(functions)
+    )
 
 
 def _get_organism(data: Dict[str, Any]) -> str: 
     return f"lineage: {data['organism']['lineage'][-1]}, organism: {data['organism']['scientificName']}"
 
 
-def _get_family(data: Dict[str, Any]) -> str: 
-    comments: List[Dict[str, Any]] = data["comments"]
-    similarities = [
+def _get_family(buckets: Dict[str, List[Dict[str, Any]]]) -> str:
+    return " | ".join(
         text["value"]
-        for comment in comments if comment["commentType"] == "SIMILARITY"
+        for comment in buckets.get("SIMILARITY", [])
         for text in comment["texts"]
-    ]
-    return " | ".join(similarities)
+    )
 
 
-def _get_domain(data: Dict[str, Any]) -> str: 
-    comments: List[Dict[str, Any]] = data["comments"]
-    domains = [
+def _get_domain(buckets: Dict[str, List[Dict[str, Any]]]) -> str:
+    return " | ".join(
         text["value"]
-        for comment in comments if comment["commentType"] == "DOMAIN"
+        for comment in buckets.get("DOMAIN", [])
         for text in comment["texts"]
-    ]
-    return " | ".join(domains)
+    )
 
 
-def _get_location(data: Dict[str, Any]) -> str: 
+def _get_location(buckets: Dict[str, List[Dict[str, Any]]]) -> str:
     def _format_subcellular_location(subcellular_location_data: Dict[str, Any]) -> str:
         location = (
             subcellular_location_data["location"]["value"]
@@ -105,100 +164,164 @@ def _get_location(data: Dict[str, Any]) -> str:
         )
         return f"location: {location}; topology: {topology}; orientation: {orientation}"
 
-    comments: List[Dict[str, Any]] = data["comments"]
+    comments = buckets.get("SUBCELLULAR LOCATION", [])
     locations = [
         _format_subcellular_location(subcellular_location)
-        for comment in comments if (
-            comment["commentType"] == "SUBCELLULAR LOCATION" and "subcellularLocations" in comment.keys()
-        )
+        for comment in comments if "subcellularLocations" in comment.keys()
         for subcellular_location in comment["subcellularLocations"]
     ]
     notes = [
         text["value"]
-        for comment in comments if (comment["commentType"] == "SUBCELLULAR LOCATION" and "note" in comment.keys())
+        for comment in comments if "note" in comment.keys()
         for text in comment["note"]["texts"]
     ]
     return " | ".join(locations + notes)
 
 
-def _get_subunit(data: Dict[str, Any]) -> str: 
-    comments: List[Dict[str, Any]] = data["comments"]
-    subunits = [
+def _get_subunit(buckets: Dict[str, List[Dict[str, Any]]]) -> str:
+    return " | ".join(
         text["value"]
-        for comment in comments if comment["commentType"] == "SUBUNIT"
+        for comment in buckets.get("SUBUNIT", [])
         for text in comment["texts"]
-    ]
-    return " | ".join(subunits)
+    )
 
 
-def _get_activity(data: Dict[str, Any]) -> str: 
-    comments: List[Dict[str, Any]] = data["comments"]
-    activities = [
-        comment["reaction"]["name"] for comment in comments
-        if comment["commentType"] == "CATALYTIC ACTIVITY"
-    ]
-    return " | ".join(activities)
+def _get_activity(buckets: Dict[str, List[Dict[str, Any]]]) -> str:
+    return " | ".join(
+        comment["reaction"]["name"] for comment in buckets.get("CATALYTIC ACTIVITY", [])
+    )
 
 
-def _get_cofactor(data: Dict[str, Any]) -> str: 
-    comments: List[Dict[str, Any]] = data["comments"]
+def _get_cofactor(buckets: Dict[str, List[Dict[str, Any]]]) -> str:
+    comments = buckets.get("COFACTOR", [])
     cofactors = [
         cofactor["name"]
-        for comment in comments if (comment["commentType"] == "COFACTOR" and "cofactors" in comment.keys())
+        for comment in comments if "cofactors" in comment.keys()
         for cofactor in comment["cofactors"]
     ]
     notes = [
         text["value"]
-        for comment in comments if (comment["commentType"] == "COFACTOR" and "note" in comment.keys())
+        for comment in comments if "note" in comment.keys()
         for text in comment["note"]["texts"]
     ]
     return " | ".join(cofactors + notes)
 
 
-def _get_ptm(data: Dict[str, Any]) -> str: 
-    comments: List[Dict[str, Any]] = data["comments"]
-    ptms = [
+def _get_ptm(buckets: Dict[str, List[Dict[str, Any]]]) -> str:
+    return " | ".join(
         text["value"]
-        for comment in comments if comment["commentType"] == "PTM"
+        for comment in buckets.get("PTM", [])
         for text in comment["texts"]
-    ]
-    return " | ".join(ptms)
+    )
 
 
-def _get_pathway(data: Dict[str, Any]) -> str: 
-    comments: List[Dict[str, Any]] = data["comments"]
-    pathways = [
+def _get_pathway(buckets: Dict[str, List[Dict[str, Any]]]) -> str:
+    return " | ".join(
         text["value"]
-        for comment in comments if comment["commentType"] == "PATHWAY"
+        for comment in buckets.get("PATHWAY", [])
         for text in comment["texts"]
-    ]
-    return " | ".join(pathways)
+    )
 
 
-def _get_tissue(data: Dict[str, Any]) -> str: 
-    comments: List[Dict[str, Any]] = data["comments"]
-    tissues = [
+def _get_tissue(buckets: Dict[str, List[Dict[str, Any]]]) -> str:
+    return " | ".join(
         text["value"]
-        for comment in comments if comment["commentType"] == "TISSUE SPECIFICITY"
+        for comment in buckets.get("TISSUE SPECIFICITY", [])
         for text in comment["texts"]
-    ]
-    return " | ".join(tissues)
+    )
 
 
-def _get_induction(data: Dict[str, Any]) -> str: 
-    comments: List[Dict[str, Any]] = data["comments"]
-    interactions = [
+def _get_induction(buckets: Dict[str, List[Dict[str, Any]]]) -> str:
+    return " | ".join(
         text["value"]
-        for comment in comments if comment["commentType"] == "INDUCTION"
+        for comment in buckets.get("INDUCTION", [])
         for text in comment["texts"]
-    ]
-    return " | ".join(interactions)
+    )
+
+
+# static dispatch tables so get_features calls the extractors directly instead of resolving
+# f"_get_{key}" through globals() for every key of every protein
+_DATA_EXTRACTORS: Tuple[Tuple[str, Callable[[Dict[str, Any]], str]], ...] = (
+    ("accession", _get_accession),
+    ("sequence", _get_sequence),
+    ("organism", _get_organism),
+)
+_COMMENT_EXTRACTORS: Tuple[Tuple[str, Callable[[Dict[str, List[Dict[str, Any]]]], str]], ...] = (
+    ("family", _get_family),
+    ("domain", _get_domain),
+    ("location", _get_location),
+    ("subunit", _get_subunit),
+    ("activity", _get_activity),
+    ("cofactor", _get_cofactor),
+    ("ptm", _get_ptm),
+    ("pathway", _get_pathway),
+    ("tissue", _get_tissue),
+    ("induction", _get_induction),
+    ("description", _get_description),
+)
+
+
+def _scan_pubmed(buf):
+    """
+    Single pass over utf-8 bytes replicating _PUBMED_RE: copy buf into an output buffer while
+    dropping innermost parenthesized groups that contain b"PubMed". Returns the output buffer
+    and its filled length; slicing and decoding are left to the caller.
+    """
+    out = np.empty(len(buf), dtype=np.uint8)
+    stack = np.empty(len(buf), dtype=np.int64)  # output positions of pending '('
+    depth = 0
+    out_len = 0
+    last_close = -1  # output position of the last closed group, kept or removed
+
+    for i in range(len(buf)):
+        char = buf[i]
+        if char == 40:  # '('
+            stack[depth] = out_len
+            depth += 1
+            out[out_len] = char
+            out_len += 1
+        elif char == 41 and depth > 0:  # ')'
+            depth -= 1
+            start = stack[depth]
+            # the group is innermost iff no group closed since its '(' was emitted; a marker
+            # left by a removed group exactly at this '(' position still counts as innermost
+            found = False
+            if last_close <= start:
+                for j in range(start, out_len - 5):  # b"PubMed" == [80, 117, 98, 77, 101, 100]
+                    if (
+                        out[j] == 80 and out[j + 1] == 117 and out[j + 2] == 98
+                        and out[j + 3] == 77 and out[j + 4] == 101 and out[j + 5] == 100
+                    ):
+                        found = True
+                        break
+            if found:
+                # rewinding removes the group, but the enclosing group now had a nested group
+                # and must no longer be treated as innermost
+                out_len = start
+                last_close = start
+            else:
+                out[out_len] = char
+                last_close = out_len
+                out_len += 1
+        else:
+            out[out_len] = char
+            out_len += 1
+
+    return out, out_len
+
+
+if njit is not None:
+    _scan_pubmed = njit(cache=True)(_scan_pubmed)
 
 
 def _remove_pubmed_annotation(text: str) -> str:
     """Remove innermost parentheses containing the word 'PubMed'."""
-    pattern = r'\([^()]*PubMed[^()]*\)'
-    return re.sub(pattern, '', text)
+    if '(' not in text:
+        return text
+    if njit is None:
+        return _PUBMED_RE.sub('', text)
+    out, out_len = _scan_pubmed(np.frombuffer(text.encode("utf-8"), dtype=np.uint8))
+    return out[:out_len].tobytes().decode("utf-8")
 
 
 def segment_with_overlapping(sequence: str, max_len: int, overlap_len: int) -> List[str]: 
@@ -208,58 +331,117 @@ def segment_with_overlapping(sequence: str, max_len: int, overlap_len: int) -> L
     """
     if len(sequence) <= max_len:
         return [sequence]
-    else: 
-        segments = []
-        for start_pos in range(0, len(sequence), max_len - overlap_len): 
-            segment = sequence[start_pos : start_pos+max_len]
-            if len(segment) == max_len:
-                segments.append(segment)
-        if len(sequence) > max_len:
+    else:
+        stride = max_len - overlap_len
+        starts = range(0, len(sequence) - max_len + 1, stride)
+        segments = [sequence[start_pos : start_pos+max_len] for start_pos in starts]
+        if starts[-1] + max_len < len(sequence):
             segments.append(sequence[-max_len:])
         return segments
 
 
+def _load_protein_json(read_json_path: str) -> Dict[str, Any]:
+    """Load a downloaded json file keeping only the top-level keys read by the extractors."""
+    with open(read_json_path, "rb") as read_file:
+        if ijson is None:
+            data = orjson.loads(read_file.read())
+            return {key: value for key, value in data.items() if key in _WANTED_KEYS}
+        return {key: value for key, value in ijson.kvitems(read_file, "") if key in _WANTED_KEYS}
+
+
+def protein_to_records(data: Dict[str, Any]) -> List[Dict[str, str]]:
+    """Turn a parsed UniProtKB json record into output records, one per segmented sequence."""
+    processed_data = get_features(data)
+
+    segmented_sequences = segment_with_overlapping(
+        processed_data["sequence"], max_len=1022, overlap_len=256  # (1024 - 2) exclude start and end tokens
+    )
+
+    # build the invariant fields once and only swap the sequence per segment
+    base = {key: processed_data[key] for key in _RECORD_KEYS}
+
+    records = []
+    for segmented_sequence in segmented_sequences:
+        record = dict(base)
+        record["sequence"] = segmented_sequence
+        records.append(record)
+    return records
+
+
+def protein_to_lines(data: Dict[str, Any]) -> List[bytes]:
+    """Turn a parsed UniProtKB json record into jsonl lines, one line per segmented sequence."""
+    return [orjson.dumps(record) + b"\n" for record in protein_to_records(data)]
+
+
+def _process_one(read_json_path: str) -> List[Dict[str, str]]:
+    """Process a single downloaded json file into output records, one per segmented sequence."""
+    try:
+        data = _load_protein_json(read_json_path)
+    except Exception as e:
+        print(f"{e} -- Failed to load {read_json_path}")
+        return []
+
+    return protein_to_records(data)
+
+
+def _write_parquet(record_batches: Iterable[List[Dict[str, str]]], save_path: str) -> None:
+    """Write protein record batches as a dictionary-encoded zstd-compressed parquet file."""
+    columns: Dict[str, List[str]] = {key: [] for key in _RECORD_KEYS}
+    with pq.ParquetWriter(
+        save_path, _PARQUET_SCHEMA, compression="zstd", use_dictionary=True
+    ) as writer:
+        for records in record_batches:
+            for record in records:
+                for key in _RECORD_KEYS:
+                    columns[key].append(record[key])
+            if len(columns["accession"]) >= PARQUET_BATCH_SIZE:
+                writer.write_table(pa.Table.from_pydict(columns, schema=_PARQUET_SCHEMA))
+                columns = {key: [] for key in _RECORD_KEYS}
+        if columns["accession"]:
+            writer.write_table(pa.Table.from_pydict(columns, schema=_PARQUET_SCHEMA))
+
+
+def _write_jsonl(record_batches: Iterable[List[Dict[str, str]]], save_path: str) -> None:
+    """Write protein record batches as a zstd-compressed jsonl file."""
+    compressor = zstd.ZstdCompressor(level=3, threads=-1)
+    with open(save_path, "wb", buffering=1 << 20) as raw_file, \
+            compressor.stream_writer(raw_file) as save_file:
+        for records in record_batches:
+            # ZstdCompressionWriter does not implement writelines, so join into a single write
+            save_file.write(b"".join(orjson.dumps(record) + b"\n" for record in records))
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--jsonl", action="store_true",
+        help="write a zstd-compressed jsonl file instead of the default parquet file",
+    )
+    args = parser.parse_args()
+
     for split in ["test", "val", "train"]:
         read_json_dir = os.path.join(READ_JSON_ROOT_DIR, split)
-        save_json_path = os.path.join(SAVE_JSON_DIR, f"{split}.jsonl")
+        suffix = "jsonl.zst" if args.jsonl else "parquet"
+        save_path = os.path.join(SAVE_JSON_DIR, f"{split}.{suffix}")
         if not os.path.exists(SAVE_JSON_DIR):
             os.makedirs(SAVE_JSON_DIR)
 
-        with open(save_json_path, "w") as save_file:
-
-            for file_name in tqdm(os.listdir(read_json_dir), postfix=f"{split}"):
-                try: 
-                    with open(os.path.join(read_json_dir, file_name), "r") as read_file:
-                        data = json.load(read_file)
-                except Exception as e: 
-                    print(f"{e} -- Failed to load {file_name}")
-                    continue
-
-                processed_data = get_features(data)
-                
-                segmented_sequences = segment_with_overlapping(
-                    processed_data["sequence"], max_len=1022, overlap_len=256  # (1024 - 2) exclude start and end tokens
-                )
-
-                for segmented_sequence in segmented_sequences:
-                    save_file.write(
-                        json.dumps(
-                            {
-                                "accession": processed_data["accession"],
-                                "sequence": segmented_sequence,
-                                "organism": processed_data["organism"],
-                                "family": processed_data["family"],
-                                "domain": processed_data["domain"],
-                                "location": processed_data["location"],
-                                "subunit": processed_data["subunit"],
-                                "activity": processed_data["activity"],
-                                "cofactor": processed_data["cofactor"],
-                                "ptm": processed_data["ptm"],
-                                "pathway": processed_data["pathway"],
-                                "tissue": processed_data["tissue"],
-                                "induction": processed_data["induction"],
-                                "description": processed_data["description"],
-                            }
-                        ) + "\n"
-                    )
+        # scandir yields entries with the full path precomputed, avoiding a per-file os.path.join
+        with os.scandir(read_json_dir) as entries:
+            read_json_paths = [entry.path for entry in entries if entry.name.endswith(".json")]
+
+        # each file is independent, so processing is dispatched to all cores while only the main
+        # process writes to the output file
+        with multiprocessing.Pool(os.cpu_count()) as pool:
+            record_batches = tqdm(
+                pool.imap_unordered(_process_one, read_json_paths, chunksize=256),
+                total=len(read_json_paths),
+                desc=split,
+                mininterval=1.0,
+                smoothing=0,
+                miniters=1000,
+            )
+            if args.jsonl:
+                _write_jsonl(record_batches, save_path)
+            else:
+                _write_parquet(record_batches, save_path)
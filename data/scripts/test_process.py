@@ -0,0 +1,52 @@
+"""Tests for the PubMed annotation scanner and the jsonl writer of process.py."""
+
+import orjson
+import pytest
+import zstandard as zstd
+
+from process import _PUBMED_RE, _remove_pubmed_annotation, _write_jsonl, njit
+
+
+PUBMED_CASES = [
+    "",
+    "no parens",
+    "plain (PubMed:123) tail",
+    "(PubMed:1) (PubMed:2)",
+    # nested groups: only the innermost group containing PubMed may be removed
+    "(PubMed:1 (PubMed:2))",
+    "(x (PubMed:3) PubMed y)",
+    "((PubMed:4)PubMed)",
+    "(a (PubMed) b)",
+    "(PubMed x (y) z)",
+    "nested ((PubMed)) deep",
+    "(a (PubMed) (PubMed) b)",
+    "(PubMed(PubMed)PubMed)",
+    "((a) PubMed (b))",
+    # unbalanced parentheses must be left untouched
+    "unbalanced ) here (PubMed:3)",
+    "unbalanced ( here PubMed",
+    "a) (PubMed) (b",
+    "(()) (PubMed)",
+    # multi-byte utf-8 around the annotation
+    "accents é (PubMed:12, à voir) fin",
+]
+
+
+@pytest.mark.skipif(njit is None, reason="without Numba the regex itself is used")
+@pytest.mark.parametrize("text", PUBMED_CASES)
+def test_scan_pubmed_matches_regex(text):
+    assert _remove_pubmed_annotation(text) == _PUBMED_RE.sub('', text)
+
+
+def test_write_jsonl_round_trip(tmp_path):
+    batches = [
+        [{"accession": "P1", "sequence": "MKV"}, {"accession": "P1", "sequence": "KVM"}],
+        [],
+        [{"accession": "P2", "sequence": "AA"}],
+    ]
+    save_path = str(tmp_path / "out.jsonl.zst")
+    _write_jsonl(batches, save_path)
+
+    with open(save_path, "rb") as f, zstd.ZstdDecompressor().stream_reader(f) as reader:
+        lines = reader.read().splitlines()
+    assert [orjson.loads(line) for line in lines] == [record for batch in batches for record in batch]